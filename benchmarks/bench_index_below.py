@@ -0,0 +1,115 @@
+"""Time TimestampedData._index_below against other ways of finding the last
+reading at or before a time, for queries which step through the readings by
+different strides. Stride 1 is one query per reading; a video frame looked up
+against a faster sensor skips several readings per query. "random" is
+unordered queries.
+
+"guess w=N" remembers the previous answer and steps through up to N readings
+after it before falling back to a binary search. It only beats the
+np.searchsorted function, never the ndarray.searchsorted method which
+_index_below uses, because the Python-level checks cost more than the search
+they save.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_index_below
+"""
+import timeit
+
+import numpy as np
+
+from imu_load.imu_load import Timestamped4Vec
+
+NUM_READINGS = 200000
+NUM_QUERIES = 20000
+REPEATS = 15
+GUESS_WINDOWS = (1, 2, 4, 8)
+
+
+def make_readings():
+    # Irregular gaps of 1-2ms between readings, as from a phone sensor
+    gaps = np.random.RandomState(0).randint(1000000, 2000000, NUM_READINGS)
+    vec = Timestamped4Vec.__new__(Timestamped4Vec)
+    vec._set_timestamps(np.cumsum(gaps).astype(np.int64))
+    return vec
+
+
+def make_queries(timestamps, stride):
+    if stride is None:
+        queries = np.random.RandomState(1).randint(timestamps[0], timestamps[-1], NUM_QUERIES)
+    else:
+        # Just after a reading, so each query falls between two readings
+        queries = timestamps[:-1:stride][:NUM_QUERIES] + 1
+    return [int(q) for q in queries]
+
+
+class GuessedLookup(object):
+    """Remember the last answer, and try the next few readings after it before
+    doing a binary search."""
+
+    def __init__(self, timestamps, window):
+        self.timestamps = timestamps
+        self.window = window
+        self.guess_idx = 0
+
+    def __call__(self, time_in_ns):
+        timestamps = self.timestamps
+        last_idx = timestamps.size - 1
+        guess = self.guess_idx
+
+        item = timestamps.item
+        if item(guess) <= time_in_ns:
+            window_end = min(guess + self.window, last_idx)
+            for idx in range(guess, window_end):
+                if item(idx + 1) > time_in_ns:
+                    self.guess_idx = idx
+                    return idx
+            if window_end == last_idx:
+                self.guess_idx = last_idx
+                return last_idx
+
+        idx = int(timestamps.searchsorted(time_in_ns, side='right')) - 1
+        self.guess_idx = idx
+        return idx
+
+
+def time_per_query(make_lookup, queries):
+    # A fresh lookup each run, so remembered state starts from the beginning
+    def run():
+        lookup = make_lookup()
+        for q in queries:
+            lookup(q)
+    return min(timeit.repeat(run, number=1, repeat=REPEATS)) / len(queries)
+
+
+def main():
+    vec = make_readings()
+    timestamps = vec.timestamps
+
+    header = ["stride", "np.searchsorted", "_index_below"]
+    header += ["guess w=%d" % w for w in GUESS_WINDOWS]
+    print(" ".join("%15s" % h for h in header))
+
+    for stride in (1, 2, 3, 4, 5, 8, 16, 64, None):
+        queries = make_queries(timestamps, stride)
+        expected = [int(np.searchsorted(timestamps, q, side='right')) - 1 for q in queries]
+
+        lookup_makers = [
+            lambda: lambda q: int(np.searchsorted(timestamps, q, side='right')) - 1,
+            lambda: vec._index_below,
+        ]
+        for window in GUESS_WINDOWS:
+            lookup_makers.append(lambda window=window: GuessedLookup(timestamps, window))
+
+        row = []
+        for make_lookup in lookup_makers:
+            lookup = make_lookup()
+            assert [lookup(q) for q in queries] == expected
+            row.append(time_per_query(make_lookup, queries))
+
+        print(" ".join(["%15s" % ("random" if stride is None else stride)] +
+                       ["%13.0fns" % (t * 1e9) for t in row]))
+
+
+if __name__ == '__main__':
+    main()
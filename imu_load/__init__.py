@@ -1 +1 @@
-from imu_load import *
\ No newline at end of file
+from .imu_load import *
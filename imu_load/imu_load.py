@@ -1,52 +1,180 @@
+import concurrent.futures
+import logging
 import os.path
+import re
+import tempfile
+import zipfile
 
 import numpy as np
 
+__all__ = [
+    'TimestampedData',
+    'CameraParams',
+    'RecordStartStop',
+    'Timestamped4Vec',
+    'TimestampedMtx',
+    'IMUSensorVideo',
+    'HTC1XVid',
+]
+
+logger = logging.getLogger(__name__)
+
+# The only way to read the umask is to set it, so do that once at import time
+# rather than while sensor files may be loading on other threads
+_umask = os.umask(0)
+os.umask(_umask)
+
+
+def _loadtxt_cached(fname, dtype, usecols):
+    """np.loadtxt the given comma separated file into a structured array of
+    the given dtype. The result is saved alongside as fname + ".npz", along
+    with the size and modification time of the text file, and is loaded from
+    there instead of parsing the text again as long as those still match."""
+    cache_fname = fname + ".npz"
+    source_stat = os.stat(fname)
+
+    try:
+        with np.load(cache_fname) as cached:
+            # Each cached[...] reads that member from the zip again, so only
+            # read the array once, and only if the source hasn't changed
+            if (cached['source_size'] == source_stat.st_size and
+                    cached['source_mtime_ns'] == source_stat.st_mtime_ns):
+                cached_raw = cached['raw']
+                if cached_raw.dtype == dtype:
+                    return cached_raw
+    except (IOError, OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile):
+        # No cache yet, or it is unreadable - just parse the text file
+        pass
+
+    raw = np.loadtxt(fname, delimiter=",", dtype=dtype, usecols=usecols, ndmin=1)
+
+    # Write to a temporary file next to the cache then rename it into place,
+    # so a crashed or concurrent writer never leaves a truncated cache behind
+    tmp_fname = None
+    try:
+        fd, tmp_fname = tempfile.mkstemp(suffix=".npz", prefix=os.path.basename(fname),
+                                         dir=os.path.dirname(cache_fname))
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, raw=raw, source_size=source_stat.st_size,
+                     source_mtime_ns=source_stat.st_mtime_ns)
+        # mkstemp makes the file readable only by us - give it the permissions
+        # a plain open() would, so other users of the data directory can read it
+        os.chmod(tmp_fname, 0o666 & ~_umask)
+        os.replace(tmp_fname, cache_fname)
+    except (IOError, OSError):
+        logger.debug("couldn't write cache file %s", cache_fname)
+        if tmp_fname is not None and os.path.exists(tmp_fname):
+            os.remove(tmp_fname)
+
+    return raw
+
+
+def _interp_mats(times, timestamps, data, out):
+    """Fill out[i] with the matrix linearly interpolated from data at times[i].
+    Does the same as TimestampedData.interpolated_readings_at_times but in a
+    single loop, for compiling with numba."""
+    last_idx = timestamps.size - 1
+    for i in range(times.size):
+        idx_above = np.searchsorted(timestamps, times[i], side='right')
+        idx_above = min(max(idx_above, 1), last_idx)
+        idx_below = idx_above - 1
+
+        t = (times[i] - timestamps[idx_below]) / float(timestamps[idx_above] - timestamps[idx_below])
+        for r in range(4):
+            for c in range(4):
+                out[i, r, c] = (1.0 - t) * data[idx_below, r, c] + t * data[idx_above, r, c]
+
+
+# _interp_mats compiled with numba, or False if numba isn't installed. Filled
+# in by _compiled_interp_mats the first time it is needed.
+_interp_mats_kernel = None
+
+
+def _compiled_interp_mats():
+    """Return _interp_mats compiled with numba, or None if numba isn't
+    installed. numba is optional and slow to import, so it is only imported
+    (and the kernel compiled) the first time a batch of matrices is
+    interpolated, rather than whenever this module is imported."""
+    global _interp_mats_kernel
+    if _interp_mats_kernel is None:
+        try:
+            from numba import njit
+        except ImportError:
+            # Without numba TimestampedMtx uses the plain numpy path
+            _interp_mats_kernel = False
+        else:
+            _interp_mats_kernel = njit(cache=True, fastmath=True)(_interp_mats)
+    return _interp_mats_kernel or None
+
 
 class TimestampedData(object):
+    def _set_timestamps(self, timestamps):
+        """Store the (sorted) timestamps array, along with things derived from
+        it which don't change after loading."""
+        self.timestamps = timestamps
+        self._num_readings = timestamps.size
+        if timestamps.size:
+            # Plain ints, so check_time_in_range doesn't go through numpy scalars
+            self._t_first = int(timestamps[0])
+            self._t_last = int(timestamps[-1])
+            self.total_time_ns = self._t_last - self._t_first
+        else:
+            # Nothing is in range of an empty set of readings
+            self._t_first, self._t_last = 1, 0
+            self.total_time_ns = 0
+
     def total_time(self):
         """Returns the elapsed time in nanoseconds. This only makes
         sense when we have a reading"""
-        return self.timestamps[-1] - self.timestamps[0]
+        return self.total_time_ns
 
     def __len__(self):
         return self.num_readings()
 
     def num_readings(self):
-        return self.timestamps.size
+        return self._num_readings
 
     def reading_at_time(self, time_in_ns):
         """Given some NS time, return the measurement at a given time in
         nanoseconds. doesn't perform interpolation, so if we don't have a
         reading from that time, nothing will work."""
 
-        # Find indices to all the entries of self.timestamps
-        # which match the given time (there SHOULD be only one
+        # Timestamps are sorted, so binary search for the first entry
+        # which matches the given time (there SHOULD be only one
         # of these, we hope).
-        correct_indices = np.transpose(np.nonzero(self.timestamps == time_in_ns))
-        num_matches = correct_indices.shape[0]
-        if num_matches == 0:
+        correct_index = np.searchsorted(self.timestamps, time_in_ns)
+        num_readings = self.timestamps.size
+        if correct_index == num_readings or self.timestamps[correct_index] != time_in_ns:
             # nothing round
             raise ValueError("no entry for time %d" % time_in_ns)
-        elif num_matches > 1:
+        elif correct_index + 1 < num_readings and self.timestamps[correct_index + 1] == time_in_ns:
             raise ValueError("multiple entries for timestamp %d" % time_in_ns)
-        else:
-            # We have exactly one match, which is what we want
-            correct_index = correct_indices[0, 0]
 
         # Use our overloaded __getitem__ methods
         return self[correct_index]
 
     def check_time_in_range(self, time_in_ns):
         """Makes sure time is valid"""
-        if not (self.timestamps[0] <= time_in_ns <= self.timestamps[-1]):
+        if not (self._t_first <= time_in_ns <= self._t_last):
             raise ValueError("time of %d ns is out of range" % time_in_ns)
 
+    def _check_times_in_range(self, times_in_ns):
+        """Batched version of check_time_in_range, which also makes sure we
+        have at least two readings to interpolate between."""
+        if self.timestamps.size < 2:
+            raise ValueError("need at least 2 readings to interpolate, have %d" %
+                             self.timestamps.size)
+
+        # An empty array of times is fine, and just gives an empty result
+        if times_in_ns.size:
+            self.check_time_in_range(times_in_ns.min())
+            self.check_time_in_range(times_in_ns.max())
+
     def first_reading_below(self, time_in_ns):
         """Return the value in nanoseconds and the index for the closest sample
         to the asked for time, but earlier (or at the same time)"""
 
-        idx_below = np.nonzero(self.timestamps <= time_in_ns)[0].max()
+        idx_below = self._index_below(time_in_ns)
 
         return self.timestamps[idx_below], idx_below
 
@@ -61,14 +189,29 @@ class TimestampedData(object):
         # If we are here, then we know that since we have already tested for validity
         # of the time, and we've checked that we aren't equal to the final time..
         # therefore there will definitely be at least one timestamp greater than
-        # what we have
-        idx_above = np.nonzero(self.timestamps > time_in_ns)[0].min()
+        # what we have, and it immediately follows the last one <= time_in_ns
+        idx_above = self._index_below(time_in_ns) + 1
+        if idx_above == self.timestamps.size:
+            raise ValueError("time of %d ns is out of range" % time_in_ns)
 
         return self.timestamps[idx_above], idx_above
 
+    def _index_below(self, time_in_ns):
+        """Return the index of the last timestamp <= time_in_ns."""
+        # side='right' gives us the index after the last timestamp <= time_in_ns.
+        # For a single value the method is much cheaper to call than
+        # np.searchsorted, and cheaper than first checking the slots after the
+        # previous answer in Python - see benchmarks/bench_index_below.py.
+        idx = int(self.timestamps.searchsorted(time_in_ns, side='right')) - 1
+        if idx < 0:
+            # Earlier than every reading - don't let -1 wrap round to the end
+            raise ValueError("time of %d ns is out of range" % time_in_ns)
+
+        return idx
+
     def interpolated_reading_at_time(self, time_in_ns):
         """Linearly interpolate between datapoints given some time in nanoseconds.
-        Note that this does naive t * data[i] + (1-t)*data[i+1] which isn't correct
+        Note that this does naive (1-t) * data[i] + t * data[i+1] which isn't correct
         for rotation matrices. However James did this in his code and it worked out okay.."""
 
         self.check_time_in_range(time_in_ns)
@@ -77,9 +220,9 @@ class TimestampedData(object):
         nanoseconds_above, nano_above_idx = self.first_reading_above(time_in_ns)
         nanoseconds_below, nano_below_idx = self.first_reading_below(time_in_ns)
 
-        print ("want reading at %d, got [%d,%d] and [%d,%d]" %
-               (time_in_ns, nanoseconds_below, nano_below_idx,
-                nanoseconds_above, nano_above_idx))
+        logger.debug("want reading at %d, got [%d,%d] and [%d,%d]",
+                     time_in_ns, nanoseconds_below, nano_below_idx,
+                     nanoseconds_above, nano_above_idx)
 
         diff = float(nanoseconds_above - nanoseconds_below)
 
@@ -89,54 +232,103 @@ class TimestampedData(object):
         # then t will be one.
         t = (time_in_ns - nanoseconds_below) / diff
 
-        print "t = %f" % t
+        logger.debug("t = %f", t)
 
-        return (t * self[nano_below_idx]) + ((1.0 - t) * self[nano_above_idx])
+        return ((1.0 - t) * self[nano_below_idx]) + (t * self[nano_above_idx])
+
+    def interpolated_readings_at_times(self, times_in_ns):
+        """Batched version of interpolated_reading_at_time. Takes an array of
+        times in nanoseconds and returns an array with one interpolated reading
+        per time, doing a single search over the timestamps for all of them."""
+
+        times_in_ns = np.asarray(times_in_ns)
+        self._check_times_in_range(times_in_ns)
+
+        # Index of the first timestamp strictly greater than each time. Clipping
+        # means that asking for exactly the final timestamp interpolates between
+        # the last two readings with t = 1, rather than running off the end.
+        idx_above = np.searchsorted(self.timestamps, times_in_ns, side='right')
+        idx_above = np.clip(idx_above, 1, self.timestamps.size - 1)
+        idx_below = idx_above - 1
+
+        nanoseconds_below = self.timestamps[idx_below]
+        diff = (self.timestamps[idx_above] - nanoseconds_below).astype(np.float64)
+        t = (times_in_ns - nanoseconds_below) / diff
+
+        readings_below = self[idx_below]
+        readings_above = self[idx_above]
+
+        # Add trailing axes to t so it broadcasts against each reading
+        t = t.reshape(t.shape + (1,) * (readings_below.ndim - t.ndim))
+
+        # Same as (1-t) * below + t * above, with one multiply fewer
+        return readings_below + t * (readings_above - readings_below)
 
 
 class CameraParams(object):
+    # other_data must be one or more ;-separated "key=value[,another_val]*"
+    # chunks, each with exactly one "=" in it
+    _other_data_re = re.compile(r'[^=;]*=[^=;]*(?:;[^=;]*=[^=;]*)*\Z')
+    # Matches each of those chunks, once other_data is known to be well formed
+    _key_val_re = re.compile(r'([^=;]*)=([^=;]*)')
+
     def __init__(self, fname):
-        with open(fname, 'r') as f:
-            lines = f.readlines()
+        # Read the raw bytes and decode them in one go, rather than going
+        # through the text mode line by line decoding
+        with open(fname, 'rb') as f:
+            lines = f.read().decode('utf-8').splitlines()
 
         self.data = [self._process(l) for l in lines]
 
-    @staticmethod
-    def _process(info_line):
-        print "processing %s" % info_line
-        timestamp, phone, other_data = info_line.split("::")
+        # Timestamps are parsed as strings, so convert them all in one go. The
+        # file is still usable without them, so don't fail to load if they
+        # aren't integers - we just can't say how much time has passed.
+        try:
+            self.timestamps = np.fromiter((int(d[0]) for d in self.data),
+                                          dtype=np.int64, count=len(self.data))
+        except ValueError:
+            logger.debug("non-integer timestamps in %s", fname)
+            self.timestamps = None
+
+        self._num_readings = len(self.data)
+        if self.timestamps is not None and self._num_readings > 1:
+            self.total_time_ns = int(self.timestamps[-1] - self.timestamps[0])
+        else:
+            # -1 if we only have one measurement, and therefore
+            # nothing to take difference between.
+            self.total_time_ns = -1
 
-        other_data_key_val = other_data.split(";")
+    @classmethod
+    def _process(cls, info_line):
+        logger.debug("processing %s", info_line)
+        timestamp, phone, other_data = info_line.split("::")
 
-        # stuff in other_data_key_val is of the format "key=value[,another_val]*"
-        # so we need to split based on the equals then on the commas
-        split_by_equals = [o.split("=") for o in other_data_key_val]
-        full_key_vals = [(k, v.split(",")) for (k, v) in split_by_equals]
+        # other_data is of the format "key=value[,another_val]*;key=..." so check
+        # that, then pull out each key and value with one regex pass and split
+        # the values on commas
+        if not cls._other_data_re.match(other_data):
+            raise ValueError("malformed camera parameters %r" % other_data)
 
-        ret_vals = dict(full_key_vals)
+        ret_vals = {k: v.split(",") for k, v in cls._key_val_re.findall(other_data)}
 
         return timestamp, phone, ret_vals
 
     def num_readings(self):
-        return len(self.data)
+        return self._num_readings
 
     def total_time(self):
         """Since we may not necessarily have two lines, need to be ready
-        for the possibility that we don't know how much time has passed."""
-        timestamps = [d[0] for d in self.data]
-
-        if len(timestamps) > 1:
-            return timestamps[-1] - timestamps[0]
-        else:
-            # return -1 if we only have one measurement, and therefore
-            # nothing to take difference between.
-            return -1
+        for the possibility that we don't know how much time has passed,
+        in which case this is -1."""
+        return self.total_time_ns
 
 
 class RecordStartStop(TimestampedData):
     def __init__(self, fname):
-        with open(fname, 'r') as f:
-            lines = f.readlines()
+        # Read the raw bytes and decode them in one go, rather than going
+        # through the text mode line by line decoding
+        with open(fname, 'rb') as f:
+            lines = f.read().decode('utf-8').splitlines()
 
         # Strip comments
         lines = [l for l in lines if not l.startswith('//')]
@@ -150,7 +342,7 @@ class RecordStartStop(TimestampedData):
         self.end_ns, self.end_ms_since_epoch, self.end_state = self._process(end_line)
 
         # Make an array
-        self.timestamps = np.array([self.start_ns, self.end_ns])
+        self._set_timestamps(np.array([self.start_ns, self.end_ns]))
 
     def _process(self, data_line):
         event_type, time_in_ns, wallclock_since_epoch_ms, date = data_line.split("::")
@@ -166,56 +358,84 @@ class RecordStartStop(TimestampedData):
 
 
 class Timestamped4Vec(TimestampedData):
-    def __init__(self, fname):
-        with open(fname, 'r') as f:
-            lines = f.readlines()
+    # Phone sensors don't give anything like double precision, so store the
+    # readings as float32 to halve the memory (and bandwidth) they take up.
+    _dtype = np.dtype([('timestamp', np.int64), ('data', np.float32, (4,))])
 
-        split_lines = [l.split(",")[:-1] for l in lines]
-        self.timestamps = np.array([int(ts[0]) for ts in split_lines], dtype=np.int64)
+    def __init__(self, fname):
+        # Each line is "timestamp,x,y,z,w," - the trailing comma leaves an empty
+        # final column which usecols skips. Parsing into a structured array keeps
+        # the nanosecond timestamps as exact integers rather than going via float.
+        raw = _loadtxt_cached(fname, self._dtype, usecols=range(5))
 
-        self.data = np.array([[float(f) for f in ts[1:]] for ts in split_lines],
-                             dtype=np.float64)
+        self._set_timestamps(np.ascontiguousarray(raw['timestamp']))
+        self.data = np.ascontiguousarray(raw['data'])
 
     def __getitem__(self, key):
         # Allows us to index the object to get the relevant row of data,
         # which is surely what we want.
         return self.data[key, :]
 
+    def interpolated_reading_at_time(self, time_in_ns):
+        """Linearly interpolate all four components at some time in nanoseconds.
+        time_in_ns may also be an array of times, giving one row of output per
+        time. Goes through interpolated_readings_at_times, which searches the
+        timestamps once for all components rather than once per column."""
 
-class TimestampedMtx(TimestampedData):
-    def __init__(self, fname):
-        with open(fname, 'r') as f:
-            lines = f.readlines()
+        readings = self.interpolated_readings_at_times(np.atleast_1d(time_in_ns))
+        return readings[0] if np.ndim(time_in_ns) == 0 else readings
 
-        split_lines = [l.split(",") for l in lines]
 
-        timestamps_int = [int(data[0]) for data in split_lines]
+class TimestampedMtx(TimestampedData):
+    # First element of each line is time in nanoseconds, then we have some
+    # mystery data (ie there are 17 numbers when we definitely want 16 for
+    # the matrix), then the 16 matrix entries and a trailing comma.
+    _dtype = np.dtype([('timestamp', np.int64),
+                       ('mystery', np.float64),
+                       ('data', np.float64, (4, 4))])
 
-        # we have some mystery data first (ie there are 17 numbers when we definitely
-        # want 16 for the matrix.
-        self.mystery_data_ = [data[1] for data in split_lines]
-        rot_matrices_str = [data[2:-1] for data in split_lines]
+    def __init__(self, fname):
+        raw = _loadtxt_cached(fname, self._dtype, usecols=range(18))
 
-        # First elements of each line is time in nanoseconds
-        self.timestamps = np.array(timestamps_int)
+        self._set_timestamps(np.ascontiguousarray(raw['timestamp']))
+        self.mystery_data_ = np.ascontiguousarray(raw['mystery'])
 
-        # Build matrices then reshape to 4x4. FIXME: do we need to transform here?
-        self.data = [np.array([float(r) for r in mtx]) for mtx in rot_matrices_str]
-        self.data = [m.reshape(4, 4) for m in self.data]
+        # One C-contiguous (N, 4, 4) array rather than a list of matrices, or a
+        # strided view into the structured array, so that batched interpolation
+        # gathers whole matrices from consecutive memory.
+        # FIXME: do we need to transform here?
+        self.data = np.ascontiguousarray(raw['data'])
 
     def __getitem__(self, key):
-        # Return the relevant matrix
+        # Return the relevant matrix (a view into self.data)
         return self.data[key]
 
+    def interpolated_readings_at_times(self, times_in_ns):
+        """Batched interpolation of rotation matrices. Uses a numba compiled
+        kernel when numba is installed, which avoids the numpy dispatch
+        overhead that dominates for small batches."""
+        interp_mats = _compiled_interp_mats()
+        if interp_mats is None:
+            return super(TimestampedMtx, self).interpolated_readings_at_times(times_in_ns)
+
+        times_in_ns = np.asarray(times_in_ns)
+        self._check_times_in_range(times_in_ns)
+
+        out = np.empty(times_in_ns.shape + (4, 4), dtype=self.data.dtype)
+        interp_mats(times_in_ns.ravel(), self.timestamps, self.data,
+                    out.reshape(-1, 4, 4))
+        return out
+
 
 class IMUSensorVideo(object):
+    # Subclasses add a slot for each sensor file they know about
+    __slots__ = ('vid_filename', '_sensor_names', '_pending')
+
     def __init__(self, vid_filename):
         self.vid_filename = vid_filename
 
         base_dir, vid_file_name = os.path.split(os.path.abspath(vid_filename))
 
-        self.sensor_files = []
-
         if not vid_file_name.lower().startswith("video-"):
             raise ValueError("expected filename to start with video-")
         if not vid_file_name.lower().endswith(".mp4"):
@@ -226,25 +446,85 @@ class IMUSensorVideo(object):
         # 17_Oct_2012_11-28-21_GMT
         vid_id = vid_file_name[6:-4]
 
-        print "vid_id =", vid_id
+        logger.debug("vid_id = %s", vid_id)
 
         metadata_dir_name = "videodata_video-" + vid_id
 
-        print "metadata_dir_name =", metadata_dir_name
+        logger.debug("metadata_dir_name = %s", metadata_dir_name)
 
         abs_metadata_dir = os.path.join(base_dir, metadata_dir_name)
 
+        # Sensor files aren't loaded here - we just remember where each one is,
+        # and __getattr__ loads it the first time the attribute is asked for.
         # self._filenames_and_handlers must be defined in subclass!!
+        self._sensor_names = []
+        self._pending = {}
         for fname, python_name, handler in self._filenames_and_handlers:
-
             full_fname = os.path.join(abs_metadata_dir, fname + vid_id + ".txt")
-            print "handling %s with %s" % (full_fname, handler)
-            h = handler(full_fname)
-
-            # Store both as an attribute and in a list so we can iterate over
-            # all the things which come from sensor files
-            self.__dict__[python_name] = h
-            self.sensor_files.append(h)
+            self._sensor_names.append(python_name)
+            self._pending[python_name] = (full_fname, handler)
+
+    def __getattr__(self, name):
+        # Only called when normal attribute lookup fails, ie for sensor files
+        # which haven't been loaded yet. Guard against _pending itself being
+        # unset, which would otherwise recurse back into here.
+        pending = self._pending if name != '_pending' else {}
+        if name not in pending:
+            raise AttributeError("%r object has no attribute %r" %
+                                 (type(self).__name__, name))
+
+        # Only forget about the file once it has loaded, so that if the handler
+        # raises (eg the file is missing) the next access tries again
+        full_fname, handler = pending[name]
+        logger.debug("handling %s with %s", full_fname, handler)
+        h = handler(full_fname)
+        setattr(self, name, h)
+        del pending[name]
+        return h
+
+    def _load_pending(self):
+        """Load every sensor file which hasn't been loaded yet. The files are
+        independent, and np.loadtxt releases the GIL while parsing, so load
+        them all at once on a thread pool."""
+        pending = self._pending
+        if not pending:
+            return
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(pending)) as executor:
+            futures = {}
+            for python_name, (full_fname, handler) in pending.items():
+                logger.debug("handling %s with %s", full_fname, handler)
+                futures[executor.submit(handler, full_fname)] = python_name
+
+            # Keep everything which loaded even if something else failed, so
+            # it isn't parsed again next time, then raise the first failure
+            first_error = None
+            for future in concurrent.futures.as_completed(futures):
+                python_name = futures[future]
+                try:
+                    h = future.result()
+                except Exception as e:
+                    if first_error is None:
+                        first_error = e
+                    continue
+                setattr(self, python_name, h)
+                del pending[python_name]
+
+        if first_error is not None:
+            raise first_error
+
+    @property
+    def sensor_files(self):
+        """List of all the things which come from sensor files, loading any
+        which haven't been used yet."""
+        # An AttributeError escaping a property makes Python fall back to
+        # __getattr__('sensor_files'), which would hide the real error behind
+        # "no attribute 'sensor_files'", so pass it on as something else.
+        try:
+            self._load_pending()
+            return [getattr(self, python_name) for python_name in self._sensor_names]
+        except AttributeError as e:
+            raise RuntimeError("failed to load sensor files: %s" % e)
 
     def all_times_passed(self):
         return [sf.total_time() for sf in self.sensor_files]
@@ -269,6 +549,8 @@ class HTC1XVid(IMUSensorVideo):
         ("CameraParams_", "camera_params", CameraParams),
     ]
 
+    __slots__ = tuple(python_name for _, python_name, _ in _filenames_and_handlers)
+
     def __init__(self, vid_filename):
         super(HTC1XVid, self).__init__(vid_filename)
 
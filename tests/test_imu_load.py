@@ -0,0 +1,349 @@
+import os
+import shutil
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+from imu_load import imu_load
+from imu_load.imu_load import (HTC1XVid, Timestamped4Vec, TimestampedMtx,
+                               RecordStartStop, CameraParams)
+
+
+TIMESTAMPS = np.array([1000, 2000, 3500, 4000, 6000], dtype=np.int64)
+
+
+def write_4vec(fname, timestamps, data):
+    with open(str(fname), 'w') as f:
+        for ts, row in zip(timestamps, data):
+            f.write("%d,%s,\n" % (ts, ",".join(repr(float(v)) for v in row)))
+
+
+def write_mtx(fname, timestamps, data):
+    with open(str(fname), 'w') as f:
+        for ts, mtx in zip(timestamps, data):
+            f.write("%d,3,%s,\n" % (ts, ",".join(repr(float(v)) for v in mtx.ravel())))
+
+
+@pytest.fixture
+def vec(tmp_path):
+    data = np.arange(TIMESTAMPS.size * 4, dtype=np.float64).reshape(-1, 4) ** 2
+    fname = tmp_path / "vec.txt"
+    write_4vec(fname, TIMESTAMPS, data)
+    return Timestamped4Vec(str(fname))
+
+
+@pytest.fixture
+def mtx(tmp_path):
+    data = np.arange(TIMESTAMPS.size * 16, dtype=np.float64).reshape(-1, 4, 4) ** 2
+    fname = tmp_path / "mtx.txt"
+    write_mtx(fname, TIMESTAMPS, data)
+    return TimestampedMtx(str(fname))
+
+
+@pytest.mark.parametrize("handler", ["vec", "mtx"])
+def test_interpolated_reading_at_sample_time_is_that_sample(request, handler):
+    h = request.getfixturevalue(handler)
+    # The scalar path brackets each time with the sample strictly above it,
+    # so leave out the final sample which has nothing above it
+    for i in range(h.timestamps.size - 1):
+        np.testing.assert_allclose(h.interpolated_reading_at_time(h.timestamps[i]), h[i])
+
+
+@pytest.mark.parametrize("handler", ["vec", "mtx"])
+def test_interpolated_reading_weights_nearer_sample(request, handler):
+    h = request.getfixturevalue(handler)
+    # A quarter of the way from the first to the second sample
+    t = h.timestamps[0] + (h.timestamps[1] - h.timestamps[0]) // 4
+    np.testing.assert_allclose(h.interpolated_reading_at_time(t), 0.75 * h[0] + 0.25 * h[1])
+
+
+def test_first_reading_below_before_first_sample_raises(vec):
+    with pytest.raises(ValueError):
+        vec.first_reading_below(vec.timestamps[0] - 1)
+
+
+def test_first_reading_above_after_last_sample_raises(vec):
+    with pytest.raises(ValueError):
+        vec.first_reading_above(vec.timestamps[-1] + 1)
+
+
+def test_first_reading_below_and_above_bracket_time(vec):
+    ts = vec.timestamps
+    # Out of order, as well as repeated and increasing times
+    for i in [2, 0, 3, 1, 1, 2]:
+        assert vec.first_reading_below(ts[i]) == (ts[i], i)
+        assert vec.first_reading_below(ts[i] + 1) == (ts[i], i)
+        assert vec.first_reading_above(ts[i]) == (ts[i + 1], i + 1)
+
+
+@pytest.mark.parametrize("handler", ["vec", "mtx"])
+def test_batched_interpolation_matches_scalar(request, handler):
+    h = request.getfixturevalue(handler)
+    ts = h.timestamps
+    times = np.array([ts[0], ts[0] + 250, ts[2] + 100, ts[3], ts[-1] - 1])
+    expected = np.array([h.interpolated_reading_at_time(t) for t in times])
+    np.testing.assert_allclose(h.interpolated_readings_at_times(times), expected)
+
+
+@pytest.mark.parametrize("handler", ["vec", "mtx"])
+def test_batched_interpolation_at_final_sample(request, handler):
+    h = request.getfixturevalue(handler)
+    np.testing.assert_allclose(h.interpolated_readings_at_times(h.timestamps[-1:]), h[-1:])
+
+
+@pytest.mark.parametrize("handler", ["vec", "mtx"])
+def test_batched_interpolation_of_no_times(request, handler):
+    h = request.getfixturevalue(handler)
+    readings = h.interpolated_readings_at_times(np.array([], dtype=np.int64))
+    assert readings.shape == (0,) + h[0].shape
+
+
+@pytest.mark.parametrize("handler", ["vec", "mtx"])
+def test_batched_interpolation_out_of_range_raises(request, handler):
+    h = request.getfixturevalue(handler)
+    with pytest.raises(ValueError):
+        h.interpolated_readings_at_times(np.array([h.timestamps[0] - 1]))
+
+
+def test_interpolation_with_single_reading_raises(tmp_path):
+    fname = tmp_path / "vec.txt"
+    write_4vec(fname, TIMESTAMPS[:1], np.ones((1, 4)))
+    vec = Timestamped4Vec(str(fname))
+    with pytest.raises(ValueError):
+        vec.interpolated_reading_at_time(TIMESTAMPS[0])
+
+
+@pytest.fixture
+def vid_fname(tmp_path):
+    """Write a video file name and a matching videodata_video-* directory
+    holding a small file for every sensor an HTC1XVid looks for."""
+    vid_id = "17_Oct_2012_11-28-21_GMT"
+    metadata_dir = tmp_path / ("videodata_video-" + vid_id)
+    metadata_dir.mkdir()
+
+    vecs = np.arange(TIMESTAMPS.size * 4, dtype=np.float64).reshape(-1, 4)
+    mtxs = np.arange(TIMESTAMPS.size * 16, dtype=np.float64).reshape(-1, 4, 4)
+
+    for fname, _, handler in HTC1XVid._filenames_and_handlers:
+        full_fname = metadata_dir / (fname + vid_id + ".txt")
+        if handler is Timestamped4Vec:
+            write_4vec(full_fname, TIMESTAMPS, vecs)
+        elif handler is TimestampedMtx:
+            write_mtx(full_fname, TIMESTAMPS, mtxs)
+        elif handler is RecordStartStop:
+            full_fname.write_text("// comment\n"
+                                  "Start::%d::1350473301000::Wed Oct 17\n"
+                                  "Stop::%d::1350473311000::Wed Oct 17\n"
+                                  % (TIMESTAMPS[0], TIMESTAMPS[-1]))
+        elif handler is CameraParams:
+            full_fname.write_text("%d::HTC One X::a=1,2;b=3\n" % TIMESTAMPS[0])
+
+    vid_fname = tmp_path / ("video-" + vid_id + ".mp4")
+    vid_fname.write_bytes(b"")
+    return str(vid_fname)
+
+
+def sensor_fname(vid_fname, prefix):
+    base_dir, name = os.path.split(vid_fname)
+    vid_id = name[6:-4]
+    return os.path.join(base_dir, "videodata_video-" + vid_id, prefix + vid_id + ".txt")
+
+
+def test_sensors_load_lazily(vid_fname):
+    vid = HTC1XVid(vid_fname)
+    assert set(vid._pending) == set(vid._sensor_names)
+
+    assert vid.rot.data.shape == (TIMESTAMPS.size, 4, 4)
+    assert "rot" not in vid._pending
+    assert "pan_grav" in vid._pending
+
+    assert len(vid.sensor_files) == len(HTC1XVid._filenames_and_handlers)
+    assert not vid._pending
+    assert vid.all_times_passed()[0] == TIMESTAMPS[-1] - TIMESTAMPS[0]
+
+
+def test_missing_sensor_file_can_be_retried(vid_fname):
+    fname = sensor_fname(vid_fname, "RotationMatrix_")
+    shutil.move(fname, fname + ".moved")
+
+    vid = HTC1XVid(vid_fname)
+    for _ in range(2):
+        with pytest.raises(IOError):
+            vid.rot
+
+    shutil.move(fname + ".moved", fname)
+    assert vid.rot.data.shape == (TIMESTAMPS.size, 4, 4)
+
+
+def test_sensor_files_does_not_hide_load_errors(vid_fname):
+    def broken_handler(fname):
+        raise AttributeError("broken handler")
+
+    class BrokenVid(HTC1XVid):
+        __slots__ = ()
+        _filenames_and_handlers = [("RotationMatrix_", "rot", broken_handler)]
+
+    with pytest.raises(RuntimeError, match="broken handler"):
+        BrokenVid(vid_fname).all_times_passed()
+
+
+def test_cache_round_trip(vid_fname, monkeypatch):
+    fname = sensor_fname(vid_fname, "Panasonic_Gravity_")
+    parsed = Timestamped4Vec(fname)
+    assert os.path.exists(fname + ".npz")
+
+    # A second load must come from the cache rather than the text file
+    def no_loadtxt(*args, **kwargs):
+        raise AssertionError("parsed the text file again")
+    monkeypatch.setattr(imu_load.np, "loadtxt", no_loadtxt)
+
+    cached = Timestamped4Vec(fname)
+    np.testing.assert_array_equal(cached.timestamps, parsed.timestamps)
+    np.testing.assert_array_equal(cached.data, parsed.data)
+
+
+def test_cache_with_other_dtype_is_ignored(vid_fname):
+    fname = sensor_fname(vid_fname, "Panasonic_Gravity_")
+    old_dtype = np.dtype([('timestamp', np.int64), ('data', np.float64, (4,))])
+    imu_load._loadtxt_cached(fname, old_dtype, usecols=range(5))
+
+    vec = Timestamped4Vec(fname)
+    assert vec.data.dtype == Timestamped4Vec._dtype['data'].base
+    with np.load(fname + ".npz") as cached:
+        assert cached['raw'].dtype == Timestamped4Vec._dtype
+
+
+def test_cache_is_ignored_when_source_changes_but_keeps_mtime(vid_fname):
+    fname = sensor_fname(vid_fname, "Panasonic_Gravity_")
+    Timestamped4Vec(fname)
+
+    # Replace the file like "cp -p" would, keeping the old modification time
+    stat = os.stat(fname)
+    write_4vec(fname, TIMESTAMPS[:3], np.ones((3, 4)))
+    os.utime(fname, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+    vec = Timestamped4Vec(fname)
+    np.testing.assert_array_equal(vec.timestamps, TIMESTAMPS[:3])
+    np.testing.assert_array_equal(vec.data, np.ones((3, 4)))
+
+
+def test_import_does_not_import_numba():
+    # numba is only needed for batched matrix interpolation, so importing the
+    # package shouldn't pay for importing it
+    code = "import sys, imu_load; assert 'numba' not in sys.modules"
+    subprocess.check_call([sys.executable, "-c", code],
+                          cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def test_cache_hit_reads_each_member_once(vid_fname, monkeypatch):
+    fname = sensor_fname(vid_fname, "Panasonic_Gravity_")
+    Timestamped4Vec(fname)
+
+    keys_read = []
+    original_getitem = np.lib.npyio.NpzFile.__getitem__
+
+    def counting_getitem(self, key):
+        keys_read.append(key)
+        return original_getitem(self, key)
+    monkeypatch.setattr(np.lib.npyio.NpzFile, "__getitem__", counting_getitem)
+
+    Timestamped4Vec(fname)
+    assert sorted(keys_read) == ['raw', 'source_mtime_ns', 'source_size']
+
+
+def test_cache_file_permissions_follow_umask(vid_fname):
+    fname = sensor_fname(vid_fname, "Panasonic_Gravity_")
+    Timestamped4Vec(fname)
+    mode = os.stat(fname + ".npz").st_mode & 0o777
+    assert mode == 0o666 & ~imu_load._umask
+
+
+def test_camera_params_process_multi_value_keys():
+    assert CameraParams._process("123::HTC One X::a=1,2,3;b=x;c=") == \
+        ("123", "HTC One X", {'a': ['1', '2', '3'], 'b': ['x'], 'c': ['']})
+
+
+@pytest.mark.parametrize("other_data", ["a=1;garbage;b=2", "b=x=y", "a=1;;c=", "a=1;", ""])
+def test_camera_params_process_malformed_raises(other_data):
+    with pytest.raises(ValueError):
+        CameraParams._process("123::HTC One X::" + other_data)
+
+
+def test_camera_params_strips_line_endings(tmp_path):
+    fname = tmp_path / "camera_params.txt"
+    fname.write_bytes(b"1000::HTC One X::a=1,2;b=3\n2000::HTC One X::a=4;b=5,6\r\n")
+
+    params = CameraParams(str(fname))
+    assert params.data == [("1000", "HTC One X", {'a': ['1', '2'], 'b': ['3']}),
+                           ("2000", "HTC One X", {'a': ['4'], 'b': ['5', '6']})]
+
+
+def test_camera_params_total_time(tmp_path):
+    fname = tmp_path / "camera_params.txt"
+    fname.write_text("1000::HTC One X::a=1\n2500::HTC One X::a=2\n9000::HTC One X::a=3\n")
+
+    params = CameraParams(str(fname))
+    assert params.num_readings() == 3
+    np.testing.assert_array_equal(params.timestamps, [1000, 2500, 9000])
+    assert params.timestamps.dtype == np.int64
+    assert params.total_time() == 8000
+
+
+def test_camera_params_total_time_single_line(tmp_path):
+    fname = tmp_path / "camera_params.txt"
+    fname.write_text("1000::HTC One X::a=1\n")
+    assert CameraParams(str(fname)).total_time() == -1
+
+
+def test_camera_params_non_integer_timestamps_still_load(tmp_path):
+    fname = tmp_path / "camera_params.txt"
+    fname.write_text("start::HTC One X::a=1\n2500::HTC One X::a=2\n")
+
+    params = CameraParams(str(fname))
+    assert params.data[0] == ("start", "HTC One X", {'a': ['1']})
+    assert params.timestamps is None
+    assert params.total_time() == -1
+
+
+def test_reading_at_time_exact_match(vec):
+    for i, ts in enumerate(vec.timestamps):
+        np.testing.assert_array_equal(vec.reading_at_time(ts), vec[i])
+
+
+@pytest.mark.parametrize("offset", [-1, 1])
+def test_reading_at_time_missing_time_raises(vec, offset):
+    with pytest.raises(ValueError, match="no entry"):
+        vec.reading_at_time(vec.timestamps[2] + offset)
+
+
+def test_reading_at_time_outside_readings_raises(vec):
+    with pytest.raises(ValueError, match="no entry"):
+        vec.reading_at_time(vec.timestamps[0] - 1)
+    with pytest.raises(ValueError, match="no entry"):
+        vec.reading_at_time(vec.timestamps[-1] + 1)
+
+
+def test_reading_at_time_duplicate_timestamp_raises(tmp_path):
+    fname = tmp_path / "vec.txt"
+    timestamps = np.array([1000, 2000, 2000, 3000])
+    write_4vec(fname, timestamps, np.ones((4, 4)))
+    vec = Timestamped4Vec(str(fname))
+
+    with pytest.raises(ValueError, match="multiple entries"):
+        vec.reading_at_time(2000)
+    np.testing.assert_array_equal(vec.reading_at_time(3000), vec[3])
+
+
+def test_sensor_files_keeps_loaded_sensors_when_one_fails(vid_fname):
+    fname = sensor_fname(vid_fname, "RotationMatrix_")
+    shutil.move(fname, fname + ".moved")
+
+    vid = HTC1XVid(vid_fname)
+    with pytest.raises(IOError):
+        vid.sensor_files
+    assert list(vid._pending) == ["rot"]
+
+    shutil.move(fname + ".moved", fname)
+    assert len(vid.sensor_files) == len(HTC1XVid._filenames_and_handlers)